@@ -1,42 +1,200 @@
 from fastapi import FastAPI, UploadFile, File, Query
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import chromadb
 from sentence_transformers import SentenceTransformer
 from PIL import Image
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional
 from fastapi import HTTPException
-import io
-import json
+import os
+import re
+import asyncio
+import hashlib
+import itertools
+import threading
+import numpy as np
+import torch
 import requests
 from io import BytesIO
-
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+import orjson
+from helpers import parse_images_from_meta, load_image, EmbeddingLRU
+
+# Pure-ASGI CORS for the allow-all dev config: answers preflights directly and
+# appends the allow-origin header without CORSMiddleware's per-request origin
+# matching. Switch back to CORSMiddleware if origins need whitelisting.
+class AllowAllCORS:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        if scope["method"] == "OPTIONS" and b"access-control-request-method" in headers:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"access-control-allow-origin", b"*"),
+                    (b"access-control-allow-methods", b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"),
+                    (b"access-control-allow-headers", headers.get(b"access-control-request-headers", b"*")),
+                    (b"access-control-max-age", b"600"),
+                    (b"content-length", b"0"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", []).append((b"access-control-allow-origin", b"*"))
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(AllowAllCORS)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 # ---------- Chroma client & collections ----------
-chroma_client = chromadb.PersistentClient(path="./chroma_db")
-text_collection = chroma_client.get_collection("products_text")
-image_collection = chroma_client.get_collection("products_image")
+# Chroma runs as its own server (`chroma run --path ./chroma_db --port 8001`) so the
+# HNSW index lives outside the API process; connected on startup.
+CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8001"))
+
+chroma_client = None
+text_collection = None
+image_collection = None
+
+@app.on_event("startup")
+async def connect_chroma():
+    global chroma_client, text_collection, image_collection
+    chroma_client = await chromadb.AsyncHttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    text_collection = await chroma_client.get_collection("products_text")
+    image_collection = await chroma_client.get_collection("products_image")
 
 # ---------- Models ----------
-text_model = SentenceTransformer("all-MiniLM-L6-v2")
-clip_model = SentenceTransformer("clip-ViT-B-32")
+# Loaded once per process. On CUDA the text model runs in fp16; CLIP stays fp32
+# because its image processor feeds float32 pixel values. TORCH_COMPILE=1 also
+# compiles both encoders (first calls are slow, hence the startup warmup).
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+TORCH_COMPILE = os.getenv("TORCH_COMPILE") == "1"
+
+text_model = SentenceTransformer("all-MiniLM-L6-v2", device=DEVICE)
+clip_model = SentenceTransformer("clip-ViT-B-32", device=DEVICE)
+
+if DEVICE == "cuda":
+    text_model.half()
+    if TORCH_COMPILE:
+        text_model[0].auto_model = torch.compile(text_model[0].auto_model, mode="reduce-overhead")
+        # sentence-transformers calls the CLIP vision tower directly, not model(...)
+        clip_model[0].model.vision_model = torch.compile(clip_model[0].model.vision_model, mode="reduce-overhead")
+
+def warmup_models():
+    text_model.encode(["warmup"] * 8, normalize_embeddings=True)
+    clip_model.encode([Image.new("RGB", (224, 224))] * 8, normalize_embeddings=True)
+
+@app.on_event("startup")
+async def warmup():
+    await asyncio.to_thread(warmup_models)
+
+# ---------- Query caches ----------
+TEXT_EMB_CACHE_SIZE = 4096       # exact-match query string -> embedding
+IMAGE_EMB_CACHE_SIZE = 1024      # exact-match image bytes hash -> embedding
+# Opt-in: near-duplicate queries ("iphone 13 case" / "iphone 14 case") can clear the
+# threshold and be served each other's results, so this tier is off unless set.
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "0"))   # last K responses matched by cosine similarity
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+def _freeze(emb):
+    emb = np.asarray(emb, dtype=np.float32)
+    emb.setflags(write=False)  # shared between requests
+    return emb
+
+# Returns a cached response when a new query embedding is within `threshold`
+# cosine similarity of a recent one (embeddings are unit-norm, so a dot product).
+# `generation` is bumped by clear(); a search reads it before querying Chroma and
+# passes it to put(), so a response computed before a product write is not stored.
+class SemanticResponseCache:
+    def __init__(self, maxsize, threshold):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.embs = None
+        self.top_ks = np.zeros(maxsize, dtype=np.int64)
+        self.last_used = np.zeros(maxsize, dtype=np.int64)
+        self.responses = [None] * maxsize
+        self.size = 0
+        self.clock = itertools.count(1)
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, emb, top_k):
+        with self.lock:
+            if not self.size:
+                return None
+            sims = self.embs[:self.size] @ emb
+            sims[self.top_ks[:self.size] != top_k] = -1.0
+            slot = int(sims.argmax())
+            if sims[slot] < self.threshold:
+                return None
+            self.last_used[slot] = next(self.clock)
+            return self.responses[slot]
+
+    def put(self, emb, top_k, response, generation):
+        if not self.maxsize:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return  # a write happened while this response was being computed
+            if self.embs is None:
+                self.embs = np.zeros((self.maxsize, emb.shape[0]), dtype=np.float32)
+            if self.size < self.maxsize:
+                slot = self.size
+                self.size += 1
+            else:
+                slot = int(self.last_used.argmin())  # evict least recently used
+            self.embs[slot] = emb
+            self.top_ks[slot] = top_k
+            self.last_used[slot] = next(self.clock)
+            self.responses[slot] = response
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.size = 0
+            self.responses = [None] * self.maxsize
+
+text_emb_cache = EmbeddingLRU(TEXT_EMB_CACHE_SIZE)
+image_emb_cache = EmbeddingLRU(IMAGE_EMB_CACHE_SIZE)
+text_response_cache = SemanticResponseCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD)
+image_response_cache = SemanticResponseCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD)
+
+def encode_text_queries(queries):
+    # cached embeddings are reused; the misses are encoded in one forward pass
+    embs = [text_emb_cache.get(q) for q in queries]
+    misses = list(dict.fromkeys(q for q, emb in zip(queries, embs) if emb is None))
+    if misses:
+        encoded = text_model.encode(misses, batch_size=32, normalize_embeddings=True)
+        fresh = {q: _freeze(emb) for q, emb in zip(misses, encoded)}
+        for q, emb in fresh.items():
+            text_emb_cache.put(q, emb)
+        embs = [emb if emb is not None else fresh[q] for q, emb in zip(queries, embs)]
+    return embs
+
+def invalidate_response_caches():
+    # product writes change hits and hydrated metadata; embeddings stay valid
+    text_response_cache.clear()
+    image_response_cache.clear()
 
 # ---------- Helpers ----------
-def parse_images_from_meta(meta):
-    img_str = meta.get("images") if meta else ""
-    if not img_str:
-        return []
-    return [s.strip() for s in str(img_str).split(",") if s.strip()]
+def similarity_scores(dists):
+    # Chroma distance (1 - cosine, or 1 - dot for unit vectors in "ip" space) -> similarity,
+    # for a whole result list in one vectorised pass
+    return (1.0 - np.asarray(dists, dtype=np.float64)).round(3).tolist()
 
-def build_result_from_meta(meta, doc=None, distance=None, rank=None):
+def build_result_from_meta(meta, doc=None, similarity=None, rank=None):
     if meta.get("deleted"):  # skip deleted
         return None
     return {
@@ -46,25 +204,136 @@ def build_result_from_meta(meta, doc=None, distance=None, rank=None):
         "description": meta.get("description") or (doc or ""),
         "images": parse_images_from_meta(meta),
         "specifications": meta.get("specifications"),
-        "similarity_score": round(1 - distance, 3) if distance is not None else None,
+        "similarity_score": similarity,
         "rank": rank,
     }
 
-# ---------- Routes ----------
-@app.get("/")
-def root():
-    return {"message": "Product search (text + image) backend running."}
-
-# ---- All products with pagination ----
-@app.get("/products")
-def get_all_products(offset: int = 0, limit: int = 50):
-    results = text_collection.get(include=["documents", "metadatas"], offset=offset, limit=limit)
+PRODUCTS_STREAM_PAGE_SIZE = 500
 
+def build_product_page(results):
     products = []
     for doc, meta in zip(results["documents"], results["metadatas"]):
         item = build_result_from_meta(meta, doc)
         if item:
             products.append(item)
+    return products
+
+HYDRATE_KEYS = ("name", "description", "images", "specifications", "id", "oem_id", "deleted")
+IMAGE_ID_RE = re.compile(r"^image-(.+)-\d+$")
+
+def product_id_from_image_id(image_id):
+    # only for rows ingested without an "id" in metadata; ingest always writes it
+    match = IMAGE_ID_RE.match(image_id or "")
+    return match.group(1) if match else None
+
+async def hydrate_with_text_metadata(metas, image_ids):
+    # one batched get for all results instead of a text_collection.get per hit
+    text_ids = [f"text-{m.get('id') or product_id_from_image_id(img_id)}" for m, img_id in zip(metas, image_ids)]
+    if not text_ids:
+        return []
+    try:
+        text_res = await text_collection.get(ids=list(dict.fromkeys(text_ids)), include=["metadatas"])
+        by_id = dict(zip(text_res["ids"], text_res["metadatas"]))
+    except Exception:
+        by_id = {}
+
+    hydrated = []
+    for m, text_id in zip(metas, text_ids):
+        hydrated_meta = dict(m)
+        tmeta = by_id.get(text_id)
+        if tmeta:
+            hydrated_meta.update({k: tmeta.get(k) for k in HYDRATE_KEYS})
+        hydrated.append(hydrated_meta)
+    return hydrated
+
+# ---------- Search micro-batcher ----------
+# Concurrent /search requests that arrive within SEARCH_BATCH_WINDOW seconds share
+# one encode() call and one Chroma query.
+SEARCH_BATCH_WINDOW = 0.005
+SEARCH_BATCH_MAX = 32
+SEARCH_TOP_K_MAX = 500   # a batch queries max(top_k) rows for every request in it
+
+search_queue = None
+
+def build_text_results(metas, docs, dists):
+    out = []
+    for i, (m, doc, sim) in enumerate(zip(metas, docs, similarity_scores(dists))):
+        item = build_result_from_meta(m, doc, similarity=sim, rank=i + 1)
+        if item:
+            out.append(item)
+    return out
+
+async def run_text_search_batch(batch):
+    embs = await asyncio.to_thread(encode_text_queries, [q for q, _, _ in batch])
+
+    pending = []
+    for (q, top_k, fut), emb in zip(batch, embs):
+        cached = text_response_cache.get(emb, top_k)
+        if cached is not None:
+            if not fut.done():  # caller may have disconnected
+                fut.set_result(cached)
+        else:
+            pending.append((top_k, fut, emb))
+    if not pending:
+        return
+
+    generation = text_response_cache.generation
+    results = await text_collection.query(
+        query_embeddings=np.stack([emb for _, _, emb in pending]),
+        n_results=max(top_k for top_k, _, _ in pending),
+        include=["metadatas", "documents", "distances"],
+    )
+    for i, (top_k, fut, emb) in enumerate(pending):
+        response = {"results": build_text_results(
+            results["metadatas"][i][:top_k],
+            results["documents"][i][:top_k],
+            results["distances"][i][:top_k],
+        )}
+        text_response_cache.put(emb, top_k, response, generation)
+        if not fut.done():
+            fut.set_result(response)
+
+async def text_search_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await search_queue.get()]
+        deadline = loop.time() + SEARCH_BATCH_WINDOW
+        while len(batch) < SEARCH_BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(search_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await run_text_search_batch(batch)
+        except Exception as e:
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+async def submit_text_search(q, top_k):
+    fut = asyncio.get_running_loop().create_future()
+    await search_queue.put((q, top_k, fut))
+    return await fut
+
+@app.on_event("startup")
+async def start_search_batcher():
+    global search_queue
+    search_queue = asyncio.Queue()
+    app.state.search_worker = asyncio.create_task(text_search_worker())
+
+# ---------- Routes ----------
+@app.get("/")
+async def root():
+    return {"message": "Product search (text + image) backend running."}
+
+# ---- All products with pagination ----
+@app.get("/products")
+async def get_all_products(offset: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=500)):
+    results = await text_collection.get(include=["documents", "metadatas"], offset=offset, limit=limit)
+    products = build_product_page(results)
 
     return {
         "results": products,
@@ -73,64 +342,93 @@ def get_all_products(offset: int = 0, limit: int = 50):
         "count": len(products),
     }
 
+# ---- Full product dump, streamed page by page ----
+@app.get("/products/stream")
+async def stream_all_products():
+    async def generate():
+        yield b"["
+        offset = 0
+        first = True
+        while True:
+            results = await text_collection.get(
+                include=["documents", "metadatas"], offset=offset, limit=PRODUCTS_STREAM_PAGE_SIZE
+            )
+            if not results["ids"]:
+                break
+            products = build_product_page(results)
+            if products:
+                yield (b"" if first else b",") + orjson.dumps(products)[1:-1]
+                first = False
+            offset += PRODUCTS_STREAM_PAGE_SIZE
+        yield b"]"
+
+    return StreamingResponse(generate(), media_type="application/json")
+
 # ---- Text search ----
 @app.get("/search")
-def search_text(q: str = Query(...), top_k: int = 100):
+async def search_text(q: str = Query(...), top_k: int = Query(100, ge=1, le=SEARCH_TOP_K_MAX)):
     q = q.strip()
     if not q:
         return {"results": []}
 
-    q_emb = text_model.encode(q, normalize_embeddings=True).tolist()
-    results = text_collection.query(query_embeddings=[q_emb], n_results=top_k)
+    return await submit_text_search(q, top_k)
 
-    docs = results.get("documents", [[]])[0]
-    metas = results.get("metadatas", [[]])[0]
-    dists = results.get("distances", [[]])[0]
+class BatchSearchPayload(BaseModel):
+    queries: list[str] = Field(..., max_length=SEARCH_BATCH_MAX)   # at most one batcher round
+    top_k: int = Field(100, ge=1, le=SEARCH_TOP_K_MAX)
 
-    out = []
-    for i, (m, doc, d) in enumerate(zip(metas, docs, dists)):
-        item = build_result_from_meta(m, doc, distance=d, rank=i + 1)
-        if item:
-            out.append(item)
-    return {"results": out}
+# ---- Batched text search ----
+@app.post("/search/batch")
+async def search_text_batch(payload: BatchSearchPayload):
+    queries = [q.strip() for q in payload.queries]
+    responses = await asyncio.gather(*(
+        submit_text_search(q, payload.top_k) for q in queries if q
+    ))
+    responses = iter(responses)
+    return {"results": [next(responses)["results"] if q else [] for q in queries]}
 
 # ---- Image search ----
 @app.post("/image-search")
-async def search_image(file: UploadFile = File(...), top_k: int = 100):
+async def search_image(file: UploadFile = File(...), top_k: int = Query(100, ge=1, le=SEARCH_TOP_K_MAX)):
     data = await file.read()
-    try:
-        img = Image.open(io.BytesIO(data)).convert("RGB")
-    except Exception as e:
-        return {"error": f"Invalid image uploaded: {e}"}
+    image_key = hashlib.blake2b(data, digest_size=16).hexdigest()
+    q_emb = image_emb_cache.get(image_key)
+    if q_emb is None:
+        try:
+            img = await asyncio.to_thread(load_image, data)
+        except Exception as e:
+            return {"error": f"Invalid image uploaded: {e}"}
 
-    q_emb = clip_model.encode(img, normalize_embeddings=True).tolist()
-    results = image_collection.query(query_embeddings=[q_emb], n_results=top_k)
+        q_emb = _freeze(await asyncio.to_thread(clip_model.encode, img, normalize_embeddings=True))
+        image_emb_cache.put(image_key, q_emb)
+
+    cached = image_response_cache.get(q_emb, top_k)
+    if cached is not None:
+        return cached
+
+    generation = image_response_cache.generation
+    results = await image_collection.query(
+        query_embeddings=q_emb[None, :], n_results=top_k, include=["metadatas", "documents", "distances"]
+    )
 
     docs = results.get("documents", [[]])[0]
     metas = results.get("metadatas", [[]])[0]
-    dists = results.get("distances", [[]])[0]
+    sims = similarity_scores(results.get("distances", [[]])[0])
+    ids = results.get("ids", [[]])[0]
 
-    out = []
-    for i, (m, doc, d) in enumerate(zip(metas, docs, dists)):
-        if m.get("deleted"):  # skip deleted
-            continue
+    # skip deleted image rows, keeping the original rank of the survivors
+    live = [(i, m, doc, sim) for i, (m, doc, sim) in enumerate(zip(metas, docs, sims)) if not m.get("deleted")]
+    hydrated = await hydrate_with_text_metadata([m for _, m, _, _ in live], [ids[i] for i, _, _, _ in live])
 
-        prod_id = m.get("id")
-        hydrated_meta = dict(m)
-
-        try:
-            text_res = text_collection.get(ids=[f"text-{prod_id}"])
-            if text_res and text_res.get("metadatas") and text_res["metadatas"][0]:
-                tmeta = text_res["metadatas"][0][0] if isinstance(text_res["metadatas"][0], list) else text_res["metadatas"][0]
-                hydrated_meta.update({k: tmeta.get(k) for k in ("name", "description", "images", "specifications", "id", "oem_id", "deleted")})
-        except Exception:
-            pass
-
-        item = build_result_from_meta(hydrated_meta, doc, distance=d, rank=i + 1)
+    out = []
+    for (i, _, doc, sim), hydrated_meta in zip(live, hydrated):
+        item = build_result_from_meta(hydrated_meta, doc, similarity=sim, rank=i + 1)
         if item:
             out.append(item)
 
-    return {"results": out}
+    response = {"results": out}
+    image_response_cache.put(q_emb, top_k, response, generation)
+    return response
 
 class ProductPayload(BaseModel):
     id: str
@@ -141,103 +439,103 @@ class ProductPayload(BaseModel):
     specifications: Optional[str] = None
 
     # ---- Insert product ----
-def normalize_image_list(images_field):
-    if not images_field:
-        return []
-    if isinstance(images_field, list):
-        return [str(x).strip() for x in images_field if str(x).strip()]
-    s = str(images_field).strip()
-    if s.startswith("{") and s.endswith("}"):
-        s = s[1:-1].strip()
-    return [p.strip() for p in s.split(",") if p.strip()]
-
-def specs_to_string(spec_field):
-    if not spec_field:
-        return ""
-    if isinstance(spec_field, str):
-        try:
-            parsed = json.loads(spec_field)
-            return json.dumps(parsed, ensure_ascii=False)
-        except Exception:
-            return spec_field
-    try:
-        return json.dumps(spec_field, ensure_ascii=False)
-    except Exception:
-        return str(spec_field)
 # -----New product insert------
 @app.post("/insert")
-def insert_product(payload: dict):
+async def insert_product(payload: dict, verify: bool = False):
+    # upsert is idempotent; the "already exists" lookup only runs with ?verify=true
     prod_id = payload.get("id")
     if not prod_id:
         return {"error": "Product id is required"}
 
-    existing = text_collection.get(ids=[f"text-{prod_id}"])
-    if existing and existing.get("metadatas") and existing["metadatas"][0] and not existing["metadatas"][0].get("deleted", False):
-        return {"message": f"Product {prod_id} already exists"}
-
     meta = {
         "id": prod_id,
         "name": payload.get("name"),
         "description": payload.get("description"),
         "images": payload.get("images"),
         "specifications": payload.get("specifications"),
+        "type": "text",
         "deleted": False
     }
 
     doc_text = meta.get("description") or meta.get("name") or ""
-    emb = text_model.encode(doc_text, normalize_embeddings=True).tolist()
-
-    text_collection.upsert(
+    encoding = asyncio.to_thread(text_model.encode, doc_text, normalize_embeddings=True)
+    if verify:
+        existing, emb = await asyncio.gather(
+            text_collection.get(ids=[f"text-{prod_id}"], include=["metadatas"]), encoding
+        )
+        if existing and existing.get("metadatas") and existing["metadatas"][0] and not existing["metadatas"][0].get("deleted", False):
+            return {"message": f"Product {prod_id} already exists"}
+    else:
+        emb = await encoding
+
+    await text_collection.upsert(
         ids=[f"text-{prod_id}"],
         documents=[doc_text],
         metadatas=[meta],
-        embeddings=[emb],
+        embeddings=emb[None, :],
     )
 
+    invalidate_response_caches()
     return {"message": f"Product {prod_id} inserted successfully"}
 
 
 # ---- Update product ----
+FULL_RECORD_KEYS = ("id", "name", "description", "images", "specifications")   # the fields the API owns
+
 @app.post("/update")
-def update_product(payload: dict):
+async def update_product(payload: dict, merge: bool = True):
+    # merge=true (default): payload fields are merged over the stored metadata.
+    # merge=false: payload replaces the stored metadata, so it must be the full record
+    # (every key in FULL_RECORD_KEYS); only an id-only existence check is made.
     prod_id = payload.get("id")
     if not prod_id:
         return {"error": "Product id is required"}
 
-    existing = text_collection.get(ids=[f"text-{prod_id}"])
-    if not existing or not existing.get("metadatas") or not existing["metadatas"][0]:
-        return {"error": f"Product {prod_id} not found"}
-
-    meta = dict(existing["metadatas"][0])
+    if merge:
+        existing = await text_collection.get(ids=[f"text-{prod_id}"], include=["metadatas"])
+        if not existing or not existing.get("metadatas") or not existing["metadatas"][0]:
+            return {"error": f"Product {prod_id} not found"}
+        meta = dict(existing["metadatas"][0])
+    else:
+        missing = [k for k in FULL_RECORD_KEYS if k not in payload]
+        if missing:
+            return {"error": f"merge=false requires the full record; missing: {', '.join(missing)}"}
+        existing = await text_collection.get(ids=[f"text-{prod_id}"], include=[])
+        if not existing or not existing.get("ids"):
+            return {"error": f"Product {prod_id} not found"}
+        meta = {}
     meta.update(payload)
+    meta["type"] = "text"    # ingest-internal tag, never taken from the caller
     meta["deleted"] = False  # keep active if updated
 
     doc_text = meta.get("description") or meta.get("name") or ""
-    new_emb = text_model.encode(doc_text, normalize_embeddings=True).tolist()
+    new_emb = await asyncio.to_thread(text_model.encode, doc_text, normalize_embeddings=True)
 
-    text_collection.upsert(
+    await text_collection.upsert(
         ids=[f"text-{prod_id}"],
         documents=[doc_text],
         metadatas=[meta],
-        embeddings=[new_emb],
+        embeddings=new_emb[None, :],
     )
 
+    invalidate_response_caches()
     return {"message": f"Product {prod_id} updated successfully", "updated_meta": meta}
 
 # ---- Permanent delete product ----
 @app.post("/delete")
-def permanent_delete_product(payload: dict):
+async def permanent_delete_product(payload: dict):
     prod_id = payload.get("id")
     if not prod_id: 
         return {"error": "Product id is required"}
     
-    existing = text_collection.get(ids=[f"text-{prod_id}"])
+    existing = await text_collection.get(ids=[f"text-{prod_id}"], include=["metadatas"])
     if not existing or not existing.get("metadatas") or not existing["metadatas"][0]:
         return {"error": f"Product {prod_id} not found"}
 
     # Delete from collection
-    text_collection.delete(ids=[f"text-{prod_id}"])
+    await text_collection.delete(ids=[f"text-{prod_id}"])
 
+    invalidate_response_caches()
     return {"message": f"Product {prod_id}  deleted successfully"}
 
 # -----New product insert------
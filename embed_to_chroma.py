@@ -7,28 +7,46 @@ embed_to_chroma_batch.py
 - Stores image embeddings in collection "products_image"
 """
 
+import argparse
 import psycopg2
 from sentence_transformers import SentenceTransformer
 import chromadb
-import json
-import requests
-from PIL import Image
-from io import BytesIO
+from helpers import normalize_image_list, specs_to_string, load_image, EmbeddingCache, EmbeddingLRU, apply_unsafe_bulk_pragmas
+import asyncio
+import aiohttp
 from transformers import CLIPProcessor
-import time
 import shutil
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import queue
+import threading
+import torch
+import numpy as np
 
 # -------- Config ----------
 BATCH_SIZE = 500          # fetch & embed per batch
+IMAGE_BATCH_SIZE = 64     # CLIP forward-pass batch size
+IMAGE_FLUSH_SIZE = 128    # images downloaded, encoded and added to Chroma together
+DOWNLOAD_CONCURRENCY = 32 # in-flight image downloads
+DECODE_WORKERS = min(8, os.cpu_count() or 1)   # image decode processes
+URL_CACHE_SIZE = 50_000   # image URL -> embedding memo (catalogues reuse images across SKUs)
 MAX_PRODUCTS = 200000    # adjust if needed
+SPECS_MAX_CHARS = 2000    # MiniLM truncates at 256 tokens anyway; the rest is wasted tokenizer work
 DB_PATH = "./chroma_db"
+EMB_CACHE_PATH = "./emb_cache.sqlite3"   # survives clear_folder(DB_PATH)
 
-# -------- Reset ChromaDB folder ----------
+parser = argparse.ArgumentParser(description="Embed products from Postgres into ChromaDB")
+parser.add_argument("--reset", action="store_true", help="wipe the ChromaDB folder and re-embed everything")
+parser.add_argument("--unsafe-bulk", action="store_true",
+                    help="no SQLite journal/fsync while ingesting (a crash can corrupt chroma_db; pair with --reset). "
+                         "Needs chromadb 0.5.x, as pinned in requirements.txt: 1.x keeps sqlite in Rust")
+parser.add_argument("--int8-clip", action="store_true",
+                    help="CPU only: int8-quantize CLIP for ingest; stored image vectors then drift from "
+                         "the fp32 CLIP the API encodes queries with")
+args = parser.parse_args()
 
 # -------- Reset ChromaDB folder ----------
-
-
 def clear_folder(folder):
     if not os.path.exists(folder):
         return
@@ -43,7 +61,9 @@ def clear_folder(folder):
             print(f"⚠️ Failed to delete {file_path}: {e}")
     print(f"🗑️ Cleared contents of ChromaDB folder: {folder}")
 
-clear_folder(DB_PATH)
+# Default is incremental: products already in Chroma are skipped, so an interrupted run resumes
+if args.reset:
+    clear_folder(DB_PATH)
 
 
 # -------- Postgres connection ----------
@@ -54,76 +74,180 @@ conn = psycopg2.connect(
     host="host.docker.internal",  # Use host.docker.internal for Linux with extra config
     port="5432"
 )
-cur = conn.cursor()
+# Named (server-side) cursor: rows stream in itersize chunks instead of re-running
+# an ever-growing OFFSET query per batch
+cur = conn.cursor(name="prod_stream")
+cur.itersize = BATCH_SIZE
+
+# -------- Image decode pool ----------
+# JPEG/PNG decode + resize runs in worker processes, off the GIL. Workers are forked
+# here, before CUDA init and before any threads start, so the fork is safe.
+decode_pool = ProcessPoolExecutor(max_workers=DECODE_WORKERS, mp_context=multiprocessing.get_context("fork"))
+decode_pool.submit(int).result()
 
 # -------- Models ----------
 print("Loading models...")
-text_model = SentenceTransformer("all-MiniLM-L6-v2")   # text
-clip_model = SentenceTransformer("clip-ViT-B-32")      # image (CLIP)
+device = "cuda" if torch.cuda.is_available() else "cpu"
+print(f"Using device: {device}")
+text_model = SentenceTransformer("all-MiniLM-L6-v2", device=device)   # text
+clip_model = SentenceTransformer("clip-ViT-B-32", device=device)      # image (CLIP)
+if device == "cuda":
+    text_model.half()   # CLIP runs under autocast instead: its pixel values arrive as float32
+elif args.int8_clip:
+    # CPU: int8 dynamic quantization of CLIP's Linear layers (VNNI/AMX int8 GEMMs, a quarter of
+    # the fp32 weight bytes). Query-time CLIP in backend.py stays fp32, so ingest and query differ.
+    clip_model[0].model = torch.ao.quantization.quantize_dynamic(
+        clip_model[0].model, {torch.nn.Linear}, dtype=torch.qint8
+    )
 # Force fast image processor
 processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32", use_fast=True)
+text_cache = EmbeddingCache(EMB_CACHE_PATH, "all-MiniLM-L6-v2")
 print("Models loaded.")
 
 # -------- Chroma client ----------
 chroma_client = chromadb.PersistentClient(path=DB_PATH)
+if args.unsafe_bulk:
+    try:
+        apply_unsafe_bulk_pragmas(chroma_client)
+        print("⚠️ --unsafe-bulk: SQLite journaling and fsync disabled for this run")
+    except AttributeError:
+        print("⚠️ --unsafe-bulk ignored: unsupported chromadb version")
 
-# Fresh collections
-text_collection = chroma_client.create_collection(
+# Create or reuse collections (inner product: embeddings are already unit-norm, so 1 - ip == cosine distance)
+text_collection = chroma_client.get_or_create_collection(
     name="products_text",
-    metadata={"hnsw:space": "cosine"}
+    metadata={"hnsw:space": "ip"}
 )
-image_collection = chroma_client.create_collection(
+image_collection = chroma_client.get_or_create_collection(
     name="products_image",
-    metadata={"hnsw:space": "cosine"}
+    metadata={"hnsw:space": "ip"}
 )
 
 
 # -------- Helper functions ----------
-def normalize_image_list(images_field):
-    if not images_field:
-        return []
-    if isinstance(images_field, list):
-        return [str(x).strip() for x in images_field if str(x).strip()]
-    s = str(images_field).strip()
-    if s.startswith("{") and s.endswith("}"):
-        s = s[1:-1].strip()
-    return [p.strip() for p in s.split(",") if p.strip()]
-
-def specs_to_string(spec_field):
-    if not spec_field:
-        return ""
-    if isinstance(spec_field, str):
+async def fetch_image(session, sem, url, timeout=6):
+    async with sem:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+async def download_images(session, sem, urls):
+    loop = asyncio.get_running_loop()
+
+    async def download(url):
         try:
-            parsed = json.loads(spec_field)
-            return json.dumps(parsed, ensure_ascii=False)
-        except Exception:
-            return spec_field
-    try:
-        return json.dumps(spec_field, ensure_ascii=False)
-    except Exception:
-        return str(spec_field)
+            data = await fetch_image(session, sem, url)
+            return await loop.run_in_executor(decode_pool, load_image, data)   # decode in the process pool
+        except Exception as e:
+            print(f"⚠️ image failed url={url}: {e}")
+            return None
+
+    return dict(zip(urls, await asyncio.gather(*(download(url) for url in urls))))
+
+def uncached_urls(jobs, claimed):
+    # each distinct URL is downloaded and encoded at most once; `claimed` holds URLs an
+    # earlier chunk is already fetching, which are not in url_cache until that chunk encodes
+    urls = [url for url in dict.fromkeys(job[2] for job in jobs) if url not in claimed and url_cache.get(url) is None]
+    claimed.update(urls)
+    return urls
+
+def encode_new_images(images_by_url):
+    fresh = [(url, img) for url, img in images_by_url.items() if img is not None]
+    if fresh:
+        with torch.autocast("cuda", dtype=torch.float16, enabled=device == "cuda"):
+            img_embs = clip_model.encode(
+                [img for _, img in fresh], batch_size=IMAGE_BATCH_SIZE, normalize_embeddings=True, convert_to_numpy=True
+            )
+        for (url, _), emb in zip(fresh, img_embs):
+            url_cache.put(url, emb)
+    return len(fresh)
+
+def add_image_rows(jobs, n_fresh):
+    ok = [(job, url_cache.get(job[2])) for job in jobs]
+    ok = [(job, emb) for job, emb in ok if emb is not None]
+    if not ok:
+        return
+    image_collection.add(
+        ids=[job[1] for job, _ in ok],
+        documents=[job[3] for job, _ in ok],
+        embeddings=np.stack([emb for _, emb in ok]),
+        metadatas=[job[4] for job, _ in ok]
+    )
+    print(f"   🖼️ Embedded {n_fresh} new images, added {len(ok)} image rows")
+
+async def open_http_session():
+    # One pooled session for the whole run: keep-alive connections are reused across batches
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=DOWNLOAD_CONCURRENCY * 2))
+
+async def embed_images(session, jobs):
+    # Download chunk i+1 while chunk i is being encoded
+    chunks = [jobs[i:i + IMAGE_FLUSH_SIZE] for i in range(0, len(jobs), IMAGE_FLUSH_SIZE)]
+    if not chunks:
+        return
+    sem = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    claimed = set()
+    next_download = asyncio.ensure_future(download_images(session, sem, uncached_urls(chunks[0], claimed)))
+    for i, chunk in enumerate(chunks):
+        images_by_url = await next_download
+        if i + 1 < len(chunks):
+            next_download = asyncio.ensure_future(download_images(session, sem, uncached_urls(chunks[i + 1], claimed)))
+        # Only the CLIP encode leaves the loop thread: every Chroma call stays on the one
+        # thread (and sqlite connection) that --unsafe-bulk configures
+        n_fresh = await asyncio.to_thread(encode_new_images, images_by_url)
+        add_image_rows(chunk, n_fresh)
 
 # -------- Batch Processing ----------
+url_cache = EmbeddingLRU(URL_CACHE_SIZE)
 offset = 0
 total_inserted = 0
+image_loop = asyncio.new_event_loop()
+http_session = image_loop.run_until_complete(open_http_session())
+
+cur.execute(
+    "SELECT id, oem_id, name, description, images, specifications "
+    "FROM products.products_info "
+    "ORDER BY id ASC "
+    "LIMIT %s;",
+    (MAX_PRODUCTS,)
+)
+
+# Fetch the next batch from Postgres on a background thread while this one encodes
+row_batches = queue.Queue(maxsize=2)
+
+def prefetch_rows():
+    try:
+        while True:
+            rows = cur.fetchmany(BATCH_SIZE)
+            row_batches.put(rows)
+            if not rows:
+                return
+    except Exception as e:
+        row_batches.put(e)
+
+threading.Thread(target=prefetch_rows, daemon=True).start()
 
 while True:
-    cur.execute(
-        "SELECT id, oem_id, name, description, images, specifications "
-        "FROM products.products_info "
-        "ORDER BY id ASC "
-        f"LIMIT {BATCH_SIZE} OFFSET {offset};"
-    )
-    rows = cur.fetchall()
+    rows = row_batches.get()
+    if isinstance(rows, Exception):
+        raise rows
     if not rows:
         break
 
     print(f"\n📦 Processing batch offset={offset}, size={len(rows)}")
+    offset += len(rows)
+
+    # A product's text row is written after its images, so its presence means the product is done
+    done = set(text_collection.get(ids=[f"text-{row[0]}" for row in rows], include=[])["ids"])
+    rows = [row for row in rows if f"text-{row[0]}" not in done]
+    if done:
+        print(f"⏭ Skipping {len(done)} products already in Chroma")
 
     # ----- TEXT embeddings -----
+    # Each row is normalised once; its image jobs are collected in the same pass
     texts = []
     text_ids = []
     text_metas = []
+    image_jobs = []
     for prod_id, oem_id, name, description, images_field, specifications in rows:
         prod_id = str(prod_id)
         oem_id = str(oem_id) if oem_id is not None else ""   # handle NULLs
@@ -133,7 +257,7 @@ while True:
         image_list = normalize_image_list(images_field)
         images_str = ",".join(image_list)
 
-        content = f"{name}. {description}. Specs: {specs_str}"
+        content = f"{name}. {description}. Specs: {specs_str[:SPECS_MAX_CHARS]}"
 
         texts.append(content)
         text_ids.append(f"text-{prod_id}")
@@ -147,50 +271,39 @@ while True:
             "specifications": specs_str
         })
 
+        for idx, img_url in enumerate(image_list):
+            image_jobs.append((prod_id, f"image-{prod_id}-{idx}", img_url, f"{name} (image)", {
+                "id": prod_id,
+                "oem_id": oem_id,   # ✅ added here
+                "type": "image",
+                "name": name,
+                "description": description,
+                "images": images_str,
+                "specifications": specs_str
+            }))
+
+    # ----- IMAGE embeddings -----
+    # Skip images already in Chroma so re-runs don't download them again
+    if image_jobs:
+        existing = set(image_collection.get(ids=[job[1] for job in image_jobs], include=[])["ids"])
+        image_jobs = [job for job in image_jobs if job[1] not in existing]
+
+    image_loop.run_until_complete(embed_images(http_session, image_jobs))
+
+    # Text rows last: they are the resume checkpoint
     if texts:
-        text_embs = text_model.encode(texts, normalize_embeddings=True, batch_size=32).tolist()
+        text_embs = text_cache.encode(
+            texts, lambda batch: text_model.encode(batch, normalize_embeddings=True, batch_size=32)
+        )
         text_collection.add(ids=text_ids, documents=texts, embeddings=text_embs, metadatas=text_metas)
         total_inserted += len(texts)
         print(f"✅ Inserted {len(texts)} text embeddings (total={total_inserted})")
 
-    # ----- IMAGE embeddings -----
-    for prod_id, oem_id, name, description, images_field, specifications in rows:
-        prod_id = str(prod_id)
-        oem_id = str(oem_id) if oem_id is not None else ""   # handle NULLs
-        specs_str = specs_to_string(specifications)
-        image_list = normalize_image_list(images_field)
-        images_str = ",".join(image_list)
-
-        for idx, img_url in enumerate(image_list):
-            try:
-                resp = requests.get(img_url, timeout=6)
-                resp.raise_for_status()
-                img = Image.open(BytesIO(resp.content)).convert("RGB")
-                img_emb = clip_model.encode(img, normalize_embeddings=True).tolist()
-
-                image_collection.add(
-                    ids=[f"image-{prod_id}-{idx}"],
-                    documents=[f"{name} (image)"],
-                    embeddings=[img_emb],
-                    metadatas=[{
-                        "id": prod_id,
-                        "oem_id": oem_id,   # ✅ added here
-                        "type": "image",
-                        "name": name,
-                        "description": description or "",
-                        "images": images_str,
-                        "specifications": specs_str
-                    }]
-                )
-                print(f"   🖼️ image embedded {prod_id}-{idx}")
-            except Exception as e:
-                print(f"⚠️ image failed for {prod_id} url={img_url}: {e}")
-            time.sleep(0.05)  # avoid hammering servers
-
-    offset += BATCH_SIZE
-    if offset >= MAX_PRODUCTS:
-        break
+image_loop.run_until_complete(http_session.close())
+image_loop.close()
 
 print(f"\n🎉 Done. Inserted ~{total_inserted} text products into ChromaDB.")
+text_cache.close()
 cur.close()
 conn.close()
+decode_pool.shutdown()
@@ -1,22 +1,34 @@
+import argparse
 import psycopg2
 from sentence_transformers import SentenceTransformer
 import chromadb
-import json
+from helpers import normalize_image_list, specs_to_string, load_image, EmbeddingCache, EmbeddingLRU, apply_unsafe_bulk_pragmas
 import aiohttp
 import asyncio
 from PIL import Image
-from io import BytesIO
-import time
 import torch
+import numpy as np
 import os
 import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import queue
+import threading
 
 # -------- Config ----------
 BATCH_SIZE = 500         # Increased for faster processing (adjust based on memory)
 MAX_PRODUCTS = 200_000    # Adjust if needed
-IMAGE_BATCH_SIZE = 32     # Process images in batches for embedding
-SLEEP_DELAY = 0.01        # Reduced delay for image downloads (adjust based on server)
+IMAGE_BATCH_SIZE = 64     # CLIP forward-pass batch size
+IMAGE_FLUSH_SIZE = 128    # Images downloaded and encoded together
+CHROMA_ADD_BATCH = 250    # Rows per image_collection.add() call
+DECODE_WORKERS = min(8, os.cpu_count() or 1)   # Image decode processes
+URL_CACHE_SIZE = 50_000   # Image URL -> embedding memo (catalogues reuse images across SKUs)
+HOST_CONNECTION_LIMIT = 16  # Concurrent downloads per image host (server courtesy)
+MULTI_GPU = os.getenv("MULTI_GPU") == "1"   # one encode process per GPU
+CLIP_ONNX = os.getenv("CLIP_ONNX")   # e.g. ./clip_image.onnx: exported on first run, served by onnxruntime
+SPECS_MAX_CHARS = 2000    # MiniLM truncates at 256 tokens anyway; the rest is wasted tokenizer work
 DB_PATH = "./chroma_db"
+EMB_CACHE_PATH = "./emb_cache.sqlite3"   # survives clear_folder(DB_PATH)
 
 # -------- Reset ChromaDB folder ----------
 def clear_folder(folder):
@@ -33,64 +45,55 @@ def clear_folder(folder):
             print(f"⚠️ Failed to delete {file_path}: {e}")
     print(f"🗑️ Cleared contents of ChromaDB folder: {folder}")
 
-# Clear the ChromaDB folder before starting
-clear_folder(DB_PATH)
-
-# -------- Postgres connection ----------
-conn = psycopg2.connect(
-    dbname="medworld",
-    user="postgres",
-    password="1",
-    host="host.docker.internal",
-    port="5432"
-)
-cur = conn.cursor()
-
-# -------- Models ----------
-print("Loading models...")
-device = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"Using device: {device}")
-text_model = SentenceTransformer("all-MiniLM-L6-v2").to(device)   # Move to GPU if available
-clip_model = SentenceTransformer("clip-ViT-B-32").to(device)      # Move to GPU if available
-print("Models loaded.")
-
-# -------- Chroma client ----------
-chroma_client = chromadb.PersistentClient(path=DB_PATH)
-
-# Create or reuse collections
-text_collection = chroma_client.get_or_create_collection(
-    name="products_text",
-    metadata={"hnsw:space": "cosine"}
-)
-image_collection = chroma_client.get_or_create_collection(
-    name="products_image",
-    metadata={"hnsw:space": "cosine"}
-)
-
 # -------- Helper functions ----------
-def normalize_image_list(images_field):
-    if not images_field:
-        return []
-    if isinstance(images_field, list):
-        return [str(x).strip() for x in images_field if str(x).strip()]
-    s = str(images_field).strip()
-    if s.startswith("{") and s.endswith("}"):
-        s = s[1:-1].strip()
-    return [p.strip() for p in s.split(",") if p.strip()]
-
-def specs_to_string(spec_field):
-    if not spec_field:
-        return ""
-    if isinstance(spec_field, str):
-        try:
-            parsed = json.loads(spec_field)
-            return json.dumps(parsed, ensure_ascii=False)
-        except Exception:
-            return spec_field
-    try:
-        return json.dumps(spec_field, ensure_ascii=False)
-    except Exception:
-        return str(spec_field)
+def encode_texts(texts):
+    if text_pool is not None:
+        return text_model.encode_multi_process(texts, text_pool, batch_size=64, normalize_embeddings=True)
+    return text_model.encode(texts, normalize_embeddings=True, batch_size=32)
+
+def encode_images(images):
+    if clip_session is not None:
+        pixels = clip_model[0].processor(images=images, return_tensors="np")["pixel_values"]
+        embs = np.concatenate([
+            clip_session.run(None, {"pixel_values": pixels[i:i + IMAGE_BATCH_SIZE]})[0]
+            for i in range(0, len(pixels), IMAGE_BATCH_SIZE)
+        ])
+        return embs / np.linalg.norm(embs, axis=1, keepdims=True)
+    if clip_pool is not None:
+        return clip_model.encode_multi_process(images, clip_pool, batch_size=IMAGE_BATCH_SIZE, normalize_embeddings=True)
+    with torch.inference_mode(), torch.autocast("cuda", dtype=clip_dtype, enabled=use_cuda):
+        return clip_model.encode(images, normalize_embeddings=True, batch_size=IMAGE_BATCH_SIZE, convert_to_numpy=True)
+
+class ClipImageTower(torch.nn.Module):
+    # pixel_values -> projected image embedding, i.e. what clip_model.encode() computes for images
+    def __init__(self, clip):
+        super().__init__()
+        self.clip = clip
+
+    def forward(self, pixel_values):
+        return self.clip.get_image_features(pixel_values=pixel_values)
+
+def open_clip_session(path):
+    import onnxruntime as ort   # optional: only needed when CLIP_ONNX is set
+
+    if not os.path.exists(path):
+        print(f"Exporting CLIP image tower to {path}...")
+        dummy = torch.zeros(1, 3, 224, 224, device=device)
+        torch.onnx.export(
+            ClipImageTower(clip_model[0].model).eval(), (dummy,), path,
+            input_names=["pixel_values"], output_names=["image_embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            opset_version=17,
+        )
+    # TensorRT (fp16, engine cached next to the .onnx) when available, then CUDA, then CPU
+    cache_dir = os.path.dirname(os.path.abspath(path))
+    wanted = [
+        ("TensorrtExecutionProvider", {"trt_fp16_enable": True, "trt_engine_cache_enable": True, "trt_engine_cache_path": cache_dir}),
+        ("CUDAExecutionProvider", {}),
+        ("CPUExecutionProvider", {}),
+    ]
+    available = ort.get_available_providers()
+    return ort.InferenceSession(path, providers=[p for p in wanted if p[0] in available])
 
 async def fetch_image(session, url, timeout=6):
     try:
@@ -101,119 +104,301 @@ async def fetch_image(session, url, timeout=6):
     except Exception:
         return None
 
+def normalize_row(row):
+    prod_id, oem_id, name, description, images_field, specifications = row
+    image_list = normalize_image_list(images_field)
+    return {
+        "prod_id": str(prod_id),
+        "oem_id": str(oem_id) if oem_id is not None else "",
+        "name": name or "",
+        "description": description or "",
+        "specs_str": specs_to_string(specifications),
+        "image_list": image_list,
+        "images_str": ",".join(image_list),
+    }
+
+def uncached_urls(image_batch, claimed):
+    # each distinct URL is downloaded and encoded at most once; `claimed` holds URLs an
+    # earlier flush is already fetching, which are not in url_cache until that flush encodes
+    urls = [url for url in dict.fromkeys(item[4] for item in image_batch) if url not in claimed and url_cache.get(url) is None]
+    claimed.update(urls)
+    return urls
+
+async def download_images(session, urls):
+    # Fetch concurrently; decode in the process pool
+    loop = asyncio.get_running_loop()
+
+    async def download(image_url):
+        img_data = await fetch_image(session, image_url)
+        if not img_data:
+            return None
+        try:
+            return await loop.run_in_executor(decode_pool, load_image, img_data)
+        except Exception as e:
+            print(f"⚠ Image failed for url={image_url}: {e}")
+            return None
+
+    decoded = await asyncio.gather(*(download(url) for url in urls))
+    return [(url, img) for url, img in zip(urls, decoded) if img is not None]
+
+async def process_image_batch(image_batch, fresh):
+    img_ids = []
+    img_embs = []
+    img_metas = []
+    img_docs = []
+
+    if fresh:
+        # Encode off the loop thread so the next flush's downloads (already started by
+        # the caller) keep going meanwhile
+        embs = await asyncio.to_thread(encode_images, [img for _, img in fresh])
+        for (url, _), emb in zip(fresh, embs):
+            url_cache.put(url, emb)
+        print(f"   🖼 Embedded {len(fresh)} images")
+
+    for prod_id, oem_id, name, description, image_url, specs_str, idx in image_batch:
+        emb = url_cache.get(image_url)
+        if emb is None:
+            continue
+        img_ids.append(f"image-{prod_id}-{idx}")
+        img_embs.append(emb)
+        img_docs.append(f"{name} (image)")
+        img_metas.append({
+            "id": prod_id,
+            "oem_id": oem_id,
+            "type": "image",
+            "name": name,
+            "description": description or "",
+            "images": image_url,
+            "specifications": specs_str
+        })
+
+    if not img_ids:
+        return None
+    return img_ids, img_docs, np.stack(img_embs), img_metas
+
 # -------- Batch Processing ----------
-offset = 0
-total_inserted = 0
+def prefetch_rows(row_batches):
+    # Producer: keeps the next Postgres batch ready while the current one encodes
+    try:
+        while True:
+            rows = cur.fetchmany(BATCH_SIZE)
+            row_batches.put(rows)
+            if not rows:
+                return
+    except Exception as e:
+        row_batches.put(e)
+
+async def main():
+    offset = 0
+    total_inserted = 0
 
-while True:
     cur.execute(
         "SELECT id, oem_id, name, description, images, specifications "
         "FROM products.products_info "
         "ORDER BY id ASC "
-        f"LIMIT {BATCH_SIZE} OFFSET {offset};"
+        "LIMIT %s;",
+        (MAX_PRODUCTS,)
+    )
+    row_batches = queue.Queue(maxsize=2)
+    threading.Thread(target=prefetch_rows, args=(row_batches,), daemon=True).start()
+
+    # One session for the whole run so keep-alive connections and DNS lookups are reused;
+    # limit_per_host replaces the old per-image sleep as the courtesy cap
+    connector = aiohttp.TCPConnector(limit=128, limit_per_host=HOST_CONNECTION_LIMIT, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        while True:
+            rows = await asyncio.to_thread(row_batches.get)
+            if isinstance(rows, Exception):
+                raise rows
+            if not rows:
+                break
+
+            print(f"\n📦 Processing batch offset={offset}, size={len(rows)}")
+            offset += len(rows)
+
+            # A product's text row is written after its images, so its presence means the product is done
+            done = set(text_collection.get(ids=[f"text-{row[0]}" for row in rows], include=[])["ids"])
+            if done:
+                print(f"⏭ Skipping {len(done)} products already in Chroma")
+
+            # Normalise each row once; the text and image passes both read `norm`
+            norm = [normalize_row(row) for row in rows if f"text-{row[0]}" not in done]
+
+            # ----- TEXT inputs -----
+            texts = []
+            text_ids = []
+            text_metas = []
+            for r in norm:
+                # Include id and oem_id for Solution 1
+                content = f"ID: {r['prod_id']}. OEM ID: {r['oem_id']}. {r['name']}. {r['description']}. Specs: {r['specs_str'][:SPECS_MAX_CHARS]}"
+
+                texts.append(content)
+                text_ids.append(f"text-{r['prod_id']}")
+                text_metas.append({
+                    "id": r["prod_id"],
+                    "oem_id": r["oem_id"],
+                    "type": "text",
+                    "name": r["name"],
+                    "description": r["description"],
+                    "images": r["images_str"],
+                    "specifications": r["specs_str"]
+                })
+
+            # ----- IMAGE embeddings -----
+            # Process images in batches; embeddings for the whole Postgres batch are buffered
+            # and written with a few large add() calls
+            all_img_ids = []
+            all_img_docs = []
+            all_img_embs = []
+            all_img_metas = []
+
+            image_jobs = [
+                (r["prod_id"], r["oem_id"], r["name"], r["description"], img_url, r["specs_str"], idx)
+                for r in norm
+                for idx, img_url in enumerate(r["image_list"])
+            ]
+            # Skip images already in Chroma (a run that died between the image and text adds)
+            # so a resumed run doesn't download, encode and re-add them
+            if image_jobs:
+                existing = set(image_collection.get(
+                    ids=[f"image-{job[0]}-{job[6]}" for job in image_jobs], include=[]
+                )["ids"])
+                image_jobs = [job for job in image_jobs if f"image-{job[0]}-{job[6]}" not in existing]
+            flushes = [image_jobs[i:i + IMAGE_FLUSH_SIZE] for i in range(0, len(image_jobs), IMAGE_FLUSH_SIZE)]
+
+            # Download flush i+1 while flush i is being encoded
+            claimed = set()
+            if flushes:
+                next_download = asyncio.ensure_future(download_images(session, uncached_urls(flushes[0], claimed)))
+            for i, image_batch in enumerate(flushes):
+                fresh = await next_download
+                if i + 1 < len(flushes):
+                    next_download = asyncio.ensure_future(download_images(session, uncached_urls(flushes[i + 1], claimed)))
+                result = await process_image_batch(image_batch, fresh)
+                if result:
+                    img_ids, img_docs, img_embs, img_metas = result
+                    all_img_ids.extend(img_ids)
+                    all_img_docs.extend(img_docs)
+                    all_img_embs.append(img_embs)
+                    all_img_metas.extend(img_metas)
+
+            if all_img_ids:
+                all_img_embs = np.concatenate(all_img_embs)
+                for i in range(0, len(all_img_ids), CHROMA_ADD_BATCH):
+                    image_collection.add(
+                        ids=all_img_ids[i:i + CHROMA_ADD_BATCH],
+                        documents=all_img_docs[i:i + CHROMA_ADD_BATCH],
+                        embeddings=all_img_embs[i:i + CHROMA_ADD_BATCH],
+                        metadatas=all_img_metas[i:i + CHROMA_ADD_BATCH]
+                    )
+                print(f"   🖼 Added {len(all_img_ids)} image embeddings to Chroma")
+
+            # ----- TEXT embeddings -----
+            # Written last: they are the resume checkpoint
+            if texts:
+                text_embs = text_cache.encode(texts, encode_texts)
+                text_collection.add(ids=text_ids, documents=texts, embeddings=text_embs, metadatas=text_metas)
+                total_inserted += len(texts)
+                print(f"✅ Inserted {len(texts)} text embeddings (total={total_inserted})")
+
+    print(f"\n🎉 Done. Inserted ~{total_inserted} text products into ChromaDB.")
+
+# Everything below runs only in the launching process: the multi-GPU encode pools
+# spawn workers that re-import this file as __mp_main__.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed products from Postgres into ChromaDB on GPU")
+    parser.add_argument("--reset", action="store_true", help="wipe the ChromaDB folder and re-embed everything")
+    parser.add_argument("--unsafe-bulk", action="store_true",
+                        help="no SQLite journal/fsync while ingesting (a crash can corrupt chroma_db; pair with --reset). "
+                             "Needs chromadb 0.5.x, as pinned in requirements.txt: 1.x keeps sqlite in Rust")
+    args = parser.parse_args()
+
+    # Default is incremental: products already in Chroma are skipped, so an interrupted run resumes
+    if args.reset:
+        clear_folder(DB_PATH)
+
+    # -------- Postgres connection ----------
+    conn = psycopg2.connect(
+        dbname="medworld",
+        user="postgres",
+        password="1",
+        host="host.docker.internal",
+        port="5432"
+    )
+    # Named (server-side) cursor streams rows; no OFFSET re-scan per batch
+    cur = conn.cursor(name="prod_stream")
+    cur.itersize = BATCH_SIZE
+
+    # -------- Image decode pool ----------
+    # JPEG/PNG decode + resize runs in worker processes, off the GIL. Workers are forked
+    # here, before CUDA init and before any threads start, so the fork is safe.
+    decode_pool = ProcessPoolExecutor(max_workers=DECODE_WORKERS, mp_context=multiprocessing.get_context("fork"))
+    decode_pool.submit(int).result()
+
+    # -------- Models ----------
+    print("Loading models...")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Using device: {device}")
+    text_model = SentenceTransformer("all-MiniLM-L6-v2").to(device)   # Move to GPU if available
+    clip_model = SentenceTransformer("clip-ViT-B-32").to(device)      # Move to GPU if available
+    text_cache = EmbeddingCache(EMB_CACHE_PATH, "all-MiniLM-L6-v2")
+    url_cache = EmbeddingLRU(URL_CACHE_SIZE)
+
+    # On GPU: TF32 matmuls, a compiled CLIP tower and bf16 autocast (fp16 on pre-Ampere cards)
+    use_cuda = device == "cuda"
+    clip_dtype = torch.bfloat16 if use_cuda and torch.cuda.is_bf16_supported() else torch.float16
+    clip_session = open_clip_session(CLIP_ONNX) if CLIP_ONNX else None
+    multi_gpu = MULTI_GPU and torch.cuda.device_count() > 1
+    if use_cuda:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+        # Default mode: tail batches vary in size (dedupe, failed downloads), and
+        # reduce-overhead would record a new CUDA graph for every batch shape.
+        # Skipped with multi-GPU pools: they pickle the model to spawned workers, which
+        # a compiled module does not survive (and the workers would not use it anyway).
+        # sentence-transformers calls model.vision_model directly, never model(...), so
+        # that is the submodule that has to be compiled
+        if clip_session is None and not multi_gpu:
+            clip_model[0].model.vision_model = torch.compile(clip_model[0].model.vision_model)
+
+    # Opt-in (MULTI_GPU=1): one encode worker per GPU via sentence-transformers' process pools,
+    # started once and reused for the whole run
+    text_pool = clip_pool = None
+    if multi_gpu:
+        gpus = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+        text_pool = text_model.start_multi_process_pool(target_devices=gpus)
+        if clip_session is None:
+            clip_pool = clip_model.start_multi_process_pool(target_devices=gpus)
+        print(f"Multi-GPU encode pools on {gpus}")
+    elif use_cuda:
+        encode_images([Image.new("RGB", (224, 224))] * IMAGE_BATCH_SIZE)   # pay compile cost up front
+    print("Models loaded.")
+
+    # -------- Chroma client ----------
+    chroma_client = chromadb.PersistentClient(path=DB_PATH)
+    if args.unsafe_bulk:
+        try:
+            apply_unsafe_bulk_pragmas(chroma_client)
+            print("⚠️ --unsafe-bulk: SQLite journaling and fsync disabled for this run")
+        except AttributeError:
+            print("⚠️ --unsafe-bulk ignored: unsupported chromadb version")
+
+    # Create or reuse collections (inner product: embeddings are already unit-norm, so 1 - ip == cosine distance)
+    text_collection = chroma_client.get_or_create_collection(
+        name="products_text",
+        metadata={"hnsw:space": "ip"}
+    )
+    image_collection = chroma_client.get_or_create_collection(
+        name="products_image",
+        metadata={"hnsw:space": "ip"}
     )
-    rows = cur.fetchall()
-    if not rows:
-        break
-
-    print(f"\n📦 Processing batch offset={offset}, size={len(rows)}")
-
-    # ----- TEXT embeddings -----
-    texts = []
-    text_ids = []
-    text_metas = []
-    for prod_id, oem_id, name, description, images_field, specifications in rows:
-        prod_id = str(prod_id)
-        oem_id = str(oem_id) if oem_id is not None else ""
-        name = name or ""
-        description = description or ""
-        specs_str = specs_to_string(specifications)
-        image_list = normalize_image_list(images_field)
-        images_str = ",".join(image_list)
-
-        # Include id and oem_id for Solution 1
-        content = f"ID: {prod_id}. OEM ID: {oem_id}. {name}. {description}. Specs: {specs_str}"
-
-        texts.append(content)
-        text_ids.append(f"text-{prod_id}")
-        text_metas.append({
-            "id": prod_id,
-            "oem_id": oem_id,
-            "type": "text",
-            "name": name,
-            "description": description,
-            "images": images_str,
-            "specifications": specs_str
-        })
 
-    if texts:
-        text_embs = text_model.encode(texts, normalize_embeddings=True, batch_size=32).tolist()
-        text_collection.add(ids=text_ids, documents=texts, embeddings=text_embs, metadatas=text_metas)
-        total_inserted += len(texts)
-        print(f"✅ Inserted {len(texts)} text embeddings (total={total_inserted})")
-
-    # ----- IMAGE embeddings -----
-    async def process_image_batch(image_batch):
-        images = []
-        img_ids = []
-        img_metas = []
-        img_docs = []
-
-        async with aiohttp.ClientSession() as session:
-            for prod_id, oem_id, name, description, image_url, specs_str, idx in image_batch:
-                try:
-                    img_data = await fetch_image(session, image_url)
-                    if img_data:
-                        img = Image.open(BytesIO(img_data)).convert("RGB")
-                        images.append(img)
-                        img_ids.append(f"image-{prod_id}-{idx}")
-                        img_docs.append(f"{name} (image)")
-                        img_metas.append({
-                            "id": prod_id,
-                            "oem_id": oem_id,
-                            "type": "image",
-                            "name": name,
-                            "description": description or "",
-                            "images": image_url,
-                            "specifications": specs_str
-                        })
-                except Exception as e:
-                    print(f"⚠ Image failed for {prod_id} url={image_url}: {e}")
-
-        if images:
-            img_embs = clip_model.encode(images, normalize_embeddings=True, batch_size=IMAGE_BATCH_SIZE).tolist()
-            image_collection.add(
-                ids=img_ids,
-                documents=img_docs,
-                embeddings=img_embs,
-                metadatas=img_metas
-            )
-            print(f"   🖼 Embedded {len(images)} images")
-
-    # Process images in batches
-    image_batch = []
-    for prod_id, oem_id, name, description, images_field, specifications in rows:
-        prod_id = str(prod_id)
-        oem_id = str(oem_id) if oem_id is not None else ""
-        specs_str = specs_to_string(specifications)
-        image_list = normalize_image_list(images_field)
-        images_str = ",".join(image_list)
-
-        for idx, img_url in enumerate(image_list):
-            image_batch.append((prod_id, oem_id, name, description, img_url, specs_str, idx))
-            if len(image_batch) >= IMAGE_BATCH_SIZE:
-                asyncio.run(process_image_batch(image_batch))
-                image_batch = []
-            time.sleep(SLEEP_DELAY)  # Minimal delay for server courtesy
-
-    if image_batch:  # Process remaining images
-        asyncio.run(process_image_batch(image_batch))
-        image_batch = []
-
-    offset += BATCH_SIZE
-    if offset >= MAX_PRODUCTS:
-        break
-
-print(f"\n🎉 Done. Inserted ~{total_inserted} text products into ChromaDB.")
-cur.close()
-conn.close()
\ No newline at end of file
+    asyncio.run(main())
+    if text_pool is not None:
+        text_model.stop_multi_process_pool(text_pool)
+    if clip_pool is not None:
+        clip_model.stop_multi_process_pool(clip_pool)
+    text_cache.close()
+    cur.close()
+    conn.close()
+    decode_pool.shutdown()
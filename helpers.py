@@ -0,0 +1,154 @@
+"""
+helpers.py
+- Field normalisers shared by backend.py and the embed_to_chroma scripts
+- In-memory LRU and persistent content-hash caches for embeddings
+- Image decoding for the ingest decode pool
+- SQLite PRAGMA tuning for bulk Chroma ingest
+"""
+
+import re
+import json
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+import orjson
+from PIL import Image
+
+CLIP_INPUT_SIZE = 224
+
+# Comma plus surrounding whitespace between URLs in "{url1,url2}" / "url1, url2" strings
+_IMG_SEP = re.compile(r"\s*,\s*")
+
+def normalize_image_list(images_field):
+    if not images_field:
+        return []
+    if isinstance(images_field, list):   # text[] / json columns: psycopg2 already returns a list
+        return [s for s in (str(x).strip() for x in images_field) if s]
+    s = str(images_field).strip()
+    if s.startswith("{") and s.endswith("}"):   # Postgres array literal
+        s = s[1:-1].strip()
+    return [t for t in _IMG_SEP.split(s) if t]
+
+def _dumps(value):
+    # orjson rejects integers beyond 64 bits; the stdlib encoder handles them
+    try:
+        return orjson.dumps(value).decode()
+    except orjson.JSONEncodeError:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+def specs_to_string(spec_field):
+    if not spec_field:
+        return ""
+    if isinstance(spec_field, str):
+        try:
+            # stdlib parse: orjson would turn integers beyond 64 bits into floats
+            parsed = json.loads(spec_field)
+        except ValueError:
+            return spec_field
+        return _dumps(parsed)
+    try:
+        return _dumps(spec_field)
+    except (TypeError, ValueError):
+        return str(spec_field)
+
+def load_image(data):
+    # Shrink so the short side is CLIP's input size (CLIP resizes + centre-crops to it
+    # anyway); keeps the image returned from a decode worker process small.
+    # draft() lets libjpeg decode straight at 1/2-1/8 scale (JPEG only, no-op otherwise)
+    img = Image.open(BytesIO(data))
+    img.draft("RGB", (CLIP_INPUT_SIZE, CLIP_INPUT_SIZE))
+    img = img.convert("RGB")
+    w, h = img.size
+    scale = CLIP_INPUT_SIZE / min(w, h)
+    if scale < 1:
+        img = img.resize((max(CLIP_INPUT_SIZE, round(w * scale)), max(CLIP_INPUT_SIZE, round(h * scale))), Image.BICUBIC)
+    return img
+
+def parse_images_from_meta(meta):
+    img_str = meta.get("images") if meta else ""
+    if not img_str:
+        return []
+    return [s.strip() for s in str(img_str).split(",") if s.strip()]
+
+class EmbeddingLRU:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            emb = self.items.get(key)
+            if emb is not None:
+                self.items.move_to_end(key)
+            return emb
+
+    def put(self, key, emb):
+        with self.lock:
+            self.items[key] = emb
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+class EmbeddingCache:
+    """blake2b(model, content) -> float16 embedding, persisted in sqlite so
+    unchanged products skip the forward pass on the next ingest run."""
+
+    def __init__(self, path, model_name):
+        self.model_name = model_name
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, emb BLOB NOT NULL)")
+
+    def key(self, content):
+        return hashlib.blake2b(f"{self.model_name}\0{content}".encode(), digest_size=16).digest()
+
+    def encode(self, texts, encode_fn):
+        keys = [self.key(t) for t in texts]
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        for i in range(0, len(unique), 500):   # stay under SQLite's bound-parameter limit
+            chunk = unique[i:i + 500]
+            found.update(self.conn.execute(
+                f"SELECT key, emb FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            ))
+
+        misses = {k: t for k, t in zip(keys, texts) if k not in found}
+        if misses:
+            embs = encode_fn(list(misses.values()))
+            fresh = {k: np.asarray(e, dtype=np.float16).tobytes() for k, e in zip(misses, embs)}
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", fresh.items())
+            found.update(fresh)
+
+        return np.stack([np.frombuffer(found[k], dtype=np.float16) for k in keys]).astype(np.float32)
+
+    def close(self):
+        self.conn.close()
+
+
+# No rollback journal and no fsync: a crash mid-run can corrupt chroma.sqlite3, and the
+# exclusive lock keeps other processes out until the client exits
+UNSAFE_BULK_PRAGMAS = (
+    "PRAGMA journal_mode=OFF",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA locking_mode=EXCLUSIVE",
+    "PRAGMA mmap_size=30000000000",
+)
+
+def apply_unsafe_bulk_pragmas(chroma_client):
+    # chromadb's pool hands each thread its own sqlite connection and these PRAGMAs only
+    # reach the calling thread's one, so every Chroma call must stay on this thread.
+    # Reaches into chromadb 0.5.x internals (requirements.txt pins it): from 1.x the sqlite
+    # connection lives in the Rust bindings and this raises AttributeError
+    pool = chroma_client._server._sysdb._conn_pool
+    conn = pool.connect()
+    try:
+        for pragma in UNSAFE_BULK_PRAGMAS:
+            conn.execute(pragma)
+    finally:
+        pool.return_to_pool(conn)